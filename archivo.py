@@ -0,0 +1,126 @@
+"""
+Archivo de páginas descargadas para poder re-extraer los vehículos sin red.
+
+Con SCRAPER_ARCHIVO apuntando a un directorio, cada página descargada y cada DOM
+renderizado con Selenium se guarda comprimido con gzip y direccionado por su
+sha256 (objetos/ab/abcdef....gz), de modo que las páginas repetidas entre
+ejecuciones no ocupan espacio extra. Cada ejecución escribe además un manifiesto
+JSONL (manifiestos/<fecha>.jsonl) que referencia esos objetos.
+"""
+import os
+import gzip
+import json
+import hashlib
+import threading
+from datetime import datetime
+from pathlib import Path
+
+directorio_archivo = os.getenv('SCRAPER_ARCHIVO')
+
+_manifiesto = None
+_manifiesto_lock = threading.Lock()
+
+
+def archivo_activo():
+    return bool(directorio_archivo)
+
+
+def _ruta_objeto(sha, directorio=None):
+    return Path(directorio or directorio_archivo) / 'objetos' / sha[:2] / f'{sha}.gz'
+
+
+def guardar_objeto(contenido):
+    """Guarda los bytes comprimidos si no existían ya y devuelve su sha256"""
+    sha = hashlib.sha256(contenido).hexdigest()
+    ruta = _ruta_objeto(sha)
+    if not ruta.exists():
+        ruta.parent.mkdir(parents=True, exist_ok=True)
+        temporal = ruta.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        with gzip.open(temporal, 'wb') as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+    return sha
+
+
+def leer_objeto(sha, directorio=None):
+    with gzip.open(_ruta_objeto(sha, directorio), 'rb') as f:
+        return f.read()
+
+
+def _escribir_manifiesto(registro):
+    global _manifiesto
+    with _manifiesto_lock:
+        if _manifiesto is None:
+            directorio = Path(directorio_archivo) / 'manifiestos'
+            directorio.mkdir(parents=True, exist_ok=True)
+            _manifiesto = directorio / f"{datetime.now().strftime('%Y%m%dT%H%M%S')}.jsonl"
+        with open(_manifiesto, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(registro, ensure_ascii=False) + '\n')
+
+
+def archivar_pagina(url, contenido, tipo):
+    """Archiva una página suelta (p. ej. un listado) si el archivo está activo"""
+    if not archivo_activo():
+        return
+    _escribir_manifiesto({
+        'tipo': tipo,
+        'url': url,
+        'fecha': datetime.now().isoformat(),
+        'sha': guardar_objeto(contenido)
+    })
+
+
+def archivar_crudo(crudo):
+    """
+    Archiva lo descargado de un vehículo: el HTML de detalle, el DOM de la
+    descripción y los precios leídos con Selenium (que salen de varios clics y no
+    de un único DOM, por eso se guardan ya extraídos).
+    """
+    if not archivo_activo() or crudo.get('html') is None:
+        return
+    registro = {
+        'tipo': 'vehiculo',
+        'nombre': crudo['nombre'],
+        'url': crudo['url'],
+        'scraped_at': crudo['scraped_at'],
+        'html': guardar_objeto(crudo['html']),
+        'html_descripcion': None,
+        'precios': crudo.get('precios', [])
+    }
+    if crudo.get('html_descripcion') is not None:
+        registro['html_descripcion'] = guardar_objeto(crudo['html_descripcion'])
+    if 'descripcion' in crudo:
+        # Descripción reutilizada al refrescar, sin DOM renderizado que archivar
+        registro['descripcion'] = crudo['descripcion']
+    _escribir_manifiesto(registro)
+
+
+def leer_crudos(directorio=None):
+    """
+    Devuelve los crudos archivados (en directorio o, por defecto, SCRAPER_ARCHIVO)
+    listos para extraccion.construir_documento, quedándose con el registro más
+    reciente de cada URL.
+    """
+    directorio = directorio or directorio_archivo
+    registros = {}
+    for manifiesto in sorted((Path(directorio) / 'manifiestos').glob('*.jsonl')):
+        with open(manifiesto, encoding='utf-8') as f:
+            for linea in f:
+                registro = json.loads(linea)
+                if registro.get('tipo') == 'vehiculo':
+                    registros[registro['url']] = registro
+
+    crudos = []
+    for registro in registros.values():
+        crudo = {
+            'nombre': registro['nombre'],
+            'url': registro['url'],
+            'scraped_at': registro['scraped_at'],
+            'html': leer_objeto(registro['html'], directorio),
+            'html_descripcion': leer_objeto(registro['html_descripcion'], directorio) if registro['html_descripcion'] else None,
+            'precios': registro['precios']
+        }
+        if 'descripcion' in registro:
+            crudo['descripcion'] = registro['descripcion']
+        crudos.append(crudo)
+    return crudos
@@ -0,0 +1,73 @@
+"""
+Benchmark del parseo y normalización de páginas de vehículos en un pool de procesos.
+
+Usa las páginas grabadas por el scraper en el archivo (SCRAPER_ARCHIVO, ver
+archivo.py) o, si el directorio no es un archivo, sus ficheros .html sueltos, y
+mide cuántos documentos por segundo se construyen con distinto número de procesos.
+
+    python benchmark_extraccion.py archivo/ --workers 0 1 2 4 8 --chunk 8
+"""
+import os
+import time
+import argparse
+from pathlib import Path
+from archivo import leer_crudos
+from extraccion import crear_pool, construir_en_pool
+
+
+def cargar_paginas(directorio, repeticiones):
+    if (Path(directorio) / 'manifiestos').is_dir():
+        return leer_crudos(directorio) * repeticiones
+    crudos = []
+    for ruta in sorted(Path(directorio).glob('*.html')):
+        crudos.append({
+            'nombre': ruta.stem,
+            'url': ruta.stem,
+            'scraped_at': '',
+            'html': ruta.read_bytes(),
+            'html_descripcion': None,
+            'precios': []
+        })
+    return crudos * repeticiones
+
+
+def medir(crudos, workers, chunk):
+    pool = crear_pool(workers)
+    try:
+        if pool is not None:
+            # Calentar el pool para no medir el arranque de los procesos
+            construir_en_pool(pool, crudos[:workers], 1)
+        inicio = time.perf_counter()
+        construir_en_pool(pool, crudos, chunk)
+        return time.perf_counter() - inicio
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de extraccion.construir_documentos')
+    parser.add_argument('directorio', help='Archivo del scraper o directorio con páginas de detalle (*.html)')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[0] + [n for n in (1, 2, 4, 8, 16) if n <= (os.cpu_count() or 1)],
+                        help='Números de procesos a probar (0 = en el propio proceso)')
+    parser.add_argument('--chunk', type=int, default=8, help='Vehículos por tarea enviada al pool')
+    parser.add_argument('--repeticiones', type=int, default=1, help='Veces que se repite el conjunto de páginas')
+    args = parser.parse_args()
+
+    crudos = cargar_paginas(args.directorio, args.repeticiones)
+    if not crudos:
+        print(f"No hay páginas grabadas en {args.directorio}")
+        return
+
+    print(f"{len(crudos)} páginas, chunk {args.chunk}, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'segundos':>10} {'docs/s':>10} {'speedup':>8}")
+    base = None
+    for workers in args.workers:
+        segundos = medir(crudos, workers, args.chunk)
+        base = base or segundos
+        print(f"{workers:>8} {segundos:>10.2f} {len(crudos) / segundos:>10.1f} {base / segundos:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -51,14 +51,14 @@ def enviar_consulta(user_query: str):
                     function_name = tool_call.function.name
                     arguments = tool_call.function.arguments
                     
-                    if function_name == "buscar_vehiculos":
+                    if function_name in ["buscar_vehiculos", "buscar_similares"]:
                         try:
                             # Parse the arguments (they come as a JSON string)
                             arguments_dict = json.loads(arguments)
                             
                             # Call your Vercel endpoint
                             response = requests.post(
-                                "https://drenting-git-main-gustavos-projects-2cab746a.vercel.app/buscar_vehiculos",
+                                f"https://drenting-git-main-gustavos-projects-2cab746a.vercel.app/{function_name}",
                                 json={"arguments": arguments_dict},
                                 headers={"Content-Type": "application/json"},
                                 timeout=10
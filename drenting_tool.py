@@ -3,6 +3,7 @@ from typing import List, Dict
 from pymongo import MongoClient
 import openai
 from dotenv import load_dotenv
+from snapshot import obtener_snapshot
 
 load_dotenv()
 
@@ -19,6 +20,45 @@ def get_embedding(text: str) -> List[float]:
     response = openai.embeddings.create(input=text, model="text-embedding-3-small")
     return response.data[0].embedding
 
+# Elegir el precio más bajo de cada vehículo que cumpla los filtros de precio y contrato
+def filtrar_precios(results: List[Dict], filtro_precio_max: int = None, filtro_precio_min: int = None,
+                    filtro_duracion: int = None, filtro_kms: int = None) -> List[Dict]:
+    processed_results = []
+    for veh in results:
+        precios = veh.get("precios", [])
+
+        if filtro_duracion:
+            precios = [p for p in precios if p["duracion"] == filtro_duracion]
+        if filtro_kms:
+            precios = [p for p in precios if p["kms"] == filtro_kms]
+
+        if not precios:
+            continue
+
+        precios_validos = []
+        for p in precios:
+            if filtro_precio_min and p["importe"] < filtro_precio_min:
+                continue
+            if filtro_precio_max and p["importe"] > filtro_precio_max:
+                continue
+            precios_validos.append(p)
+
+        if not precios_validos:
+            continue
+
+        precio_min = min(precios_validos, key=lambda p: p["importe"])
+
+        vehiculo_info = {
+            "nombre": veh["nombre"],
+            "url": veh["url"],
+            "precio": precio_min["importe"],
+            "duracion": precio_min["duracion"],
+            "kms": precio_min["kms"]
+        }
+        processed_results.append(vehiculo_info)
+
+    return processed_results
+
 # Buscar vehículos usando vector search + filtros
 def buscar_vehiculos(consulta: str, limite: int = 5, filtro_tipo: str = None,
                      filtro_color: str = None, filtro_plazas: int = None,
@@ -28,6 +68,7 @@ def buscar_vehiculos(consulta: str, limite: int = 5, filtro_tipo: str = None,
                      filtro_combustible: str = None, filtro_consumo_max: float = None,
                      filtro_consumo_min: float = None, filtro_año_min: int = None) -> List[Dict]:
     embedding = get_embedding(consulta)
+    snapshot = obtener_snapshot()
     pipeline = []
 
     match_conditions = {}
@@ -54,70 +95,73 @@ def buscar_vehiculos(consulta: str, limite: int = 5, filtro_tipo: str = None,
             consumo_filter["$gte"] = filtro_consumo_min
         match_conditions["consumo_litros"] = consumo_filter  # este campo debe existir en documentos
 
-    if match_conditions:
-        pipeline.append({"$match": match_conditions})
-
-    pipeline.append({
-        "$vectorSearch": {
-            "queryVector": embedding,
-            "path": "embedding",
-            "numCandidates": 100,
-            "limit": limite,
-            "index": "vector_index"
-        }
-    })
-
-    pipeline.append({
-        "$project": {
-            "_id": 0,
-            "nombre": 1,
-            "url": 1,
-            "precios": 1
-        }
-    })
-
-    results = list(collection.aggregate(pipeline))
+    if snapshot is not None:
+        # Búsqueda local sobre el snapshot (SNAPSHOT_DIR), sin ir a Mongo
+        results = snapshot.buscar(embedding, snapshot.filtrar(match_conditions), limite)
+    else:
+        if match_conditions:
+            pipeline.append({"$match": match_conditions})
+
+        pipeline.append({
+            "$vectorSearch": {
+                "queryVector": embedding,
+                "path": "embedding",
+                "numCandidates": 100,
+                "limit": limite,
+                "index": "vector_index"
+            }
+        })
+
+        pipeline.append({
+            "$project": {
+                "_id": 0,
+                "nombre": 1,
+                "url": 1,
+                "precios": 1
+            }
+        })
+
+        results = list(collection.aggregate(pipeline))
+
+    processed_results = filtrar_precios(results, filtro_precio_max, filtro_precio_min,
+                                        filtro_duracion, filtro_kms)
 
-    processed_results = []
-    for veh in results:
-        precios = veh.get("precios", [])
-
-        if filtro_duracion:
-            precios = [p for p in precios if p["duracion"] == filtro_duracion]
-        if filtro_kms:
-            precios = [p for p in precios if p["kms"] == filtro_kms]
-
-        if not precios:
-            continue
-
-        precios_validos = []
-        for p in precios:
-            if filtro_precio_min and p["importe"] < filtro_precio_min:
-                continue
-            if filtro_precio_max and p["importe"] > filtro_precio_max:
-                continue
-            precios_validos.append(p)
-
-        if not precios_validos:
-            continue
+    processed_results.sort(key=lambda x: x["precio"])
 
-        precio_min = min(precios_validos, key=lambda p: p["importe"])
+    return processed_results[:limite]
 
-        vehiculo_info = {
-            "nombre": veh["nombre"],
-            "url": veh["url"],
-            "precio": precio_min["importe"],
-            "duracion": precio_min["duracion"],
-            "kms": precio_min["kms"]
-        }
-        processed_results.append(vehiculo_info)
 
-    processed_results.sort(key=lambda x: x["precio"])
+# Vehículos similares a uno dado, usando los vecinos precalculados por el scraper
+# (sin embedding ni vector search en tiempo de consulta). Los vecinos guardados son
+# candidatos (SCRAPER_VECINOS, 50 por defecto): primero se filtran y luego se recorta a limite
+def buscar_similares(url: str, limite: int = 5, filtro_precio_max: int = None,
+                     filtro_precio_min: int = None, filtro_duracion: int = None,
+                     filtro_kms: int = None) -> List[Dict]:
+    snapshot = obtener_snapshot()
+    if snapshot is not None:
+        results = snapshot.similares(url)
+    else:
+        vehiculo = collection.find_one({"url": url}, {"_id": 0, "similares": 1})
+        if not vehiculo:
+            return []
+        urls_similares = [s["url"] for s in vehiculo.get("similares", [])]
+        if not urls_similares:
+            return []
+
+        results = list(collection.find(
+            {"url": {"$in": urls_similares}},
+            {"_id": 0, "nombre": 1, "url": 1, "precios": 1}
+        ))
+        # Mantener el orden por similitud
+        orden = {u: i for i, u in enumerate(urls_similares)}
+        results.sort(key=lambda veh: orden[veh["url"]])
+
+    processed_results = filtrar_precios(results, filtro_precio_max, filtro_precio_min,
+                                        filtro_duracion, filtro_kms)
 
     return processed_results[:limite]
 
 
-
 # Formato simple para mostrar vehículos
 def format_vehicle_summary(vehicle: Dict) -> str:
     return f"- {vehicle.get('nombre', 'N/A')} | {vehicle.get('precio', 'N/A')} | {vehicle.get('url', 'N/A')}"
@@ -148,5 +192,25 @@ def handle_buscar_vehiculos(consulta, limite=5, filtro_tipo=None, filtro_color=N
         return f"❌ Error procesando la consulta: {e}"
 
 
+# Función para tool call
+def handle_buscar_similares(url, limite=5, filtro_precio_max=None, filtro_precio_min=None,
+                            filtro_duracion=None, filtro_kms=None):
+    try:
+        vehicles = buscar_similares(
+            url, limite, filtro_precio_max, filtro_precio_min,
+            filtro_duracion, filtro_kms
+        )
+        if not vehicles:
+            return "No se encontraron vehículos similares que coincidan con tu consulta."
+
+        return "\n".join(
+            f"- {v['nombre']} | {v['precio']}€/mes ({v['duracion']} meses / {v['kms']} km/año) | {v['url']}"
+            for v in vehicles
+        )
+
+    except Exception as e:
+        return f"❌ Error procesando la consulta: {e}"
+
+
 if __name__ == "__main__":
     print("Este archivo está diseñado para funcionar como Tool Function de Assistant API.")
@@ -1,5 +1,5 @@
 from fastapi import FastAPI, Request
-from drenting_tool import handle_buscar_vehiculos
+from drenting_tool import handle_buscar_vehiculos, handle_buscar_similares
 
 app = FastAPI()
 
@@ -26,3 +26,18 @@ async def buscar_vehiculos_endpoint(request: Request):
         filtro_año_min=params.get("filtro_año_min")
     )
     return {"output": response}
+
+@app.post("/buscar_similares")
+async def buscar_similares_endpoint(request: Request):
+    body = await request.json()
+    params = body.get("arguments", {})
+
+    response = handle_buscar_similares(
+        url=params.get("url"),
+        limite=params.get("limite", 5),
+        filtro_precio_max=params.get("filtro_precio_max"),
+        filtro_precio_min=params.get("filtro_precio_min"),
+        filtro_duracion=params.get("filtro_duracion"),
+        filtro_kms=params.get("filtro_kms")
+    )
+    return {"output": response}
@@ -0,0 +1,301 @@
+"""
+Extracción y normalización de los documentos de vehículos a partir del HTML.
+
+Todo lo de este módulo es CPU puro y no tiene efectos secundarios al importarse,
+de modo que puede ejecutarse en un pool de procesos (ver construir_documentos).
+El pool usa fork y arranca sus procesos al crearse, así que hay que crearlo antes
+de abrir conexiones o lanzar hilos; los procesos no reimportan el script principal.
+"""
+import os
+import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
+
+# Procesos para el parseo (0 = en el propio proceso) y vehículos por tarea
+parse_workers = int(os.getenv('SCRAPER_PARSE_WORKERS', '0'))
+parse_chunk = int(os.getenv('SCRAPER_PARSE_CHUNK', '8'))
+
+
+def obtener_datos_tecnicos(soup):
+    datos = {}
+    propiedades = soup.find_all('div', class_='car-property')
+    for prop in propiedades:
+        spans = prop.find_all(['span', 'strong'])
+        if len(spans) >= 2:
+            clave = spans[0].get_text(strip=True).lower().replace(' ', '_')
+            valor = spans[1].get_text(strip=True)
+            datos[clave] = valor
+    return datos
+
+
+def obtener_informacion(soup):
+    info_parrafos = []
+    predesc = soup.find('div', class_='preDesc')
+    if predesc:
+        parrafos = predesc.find_all('p')
+        for p in parrafos:
+            for strong in p.find_all('strong'):
+                strong.insert_before(' ')
+                strong.insert_after(' ')
+                strong.unwrap()
+            texto = p.get_text()
+            texto = re.sub(r'[\s\u00A0]+', ' ', texto).strip()
+            if texto:
+                info_parrafos.append(texto)
+    return info_parrafos
+
+
+def obtener_etiquetas_ambientales(soup):
+    """Extrae las etiquetas ambientales del vehículo"""
+    etiqueta_container = soup.find('div', class_='etiqueta-combinada-container')
+    if not etiqueta_container:
+        return None
+    
+    # Buscar la imagen de la etiqueta ambiental
+    img_etiqueta = etiqueta_container.find('img', class_='environmental-label')
+    if not img_etiqueta:
+        return None
+    
+    # Extraer el valor del atributo alt de la imagen
+    alt_text = img_etiqueta.get('alt', '')
+    return alt_text if alt_text else None
+
+
+def procesar_documento_vehiculo(vehiculo):
+    """Procesa el documento del vehículo antes de guardarlo en MongoDB"""
+    
+    # Crear una copia del documento para no modificar el original
+    vehiculo_procesado = vehiculo.copy()
+    
+    # Lista de atributos que deben contener al menos un dígito
+    atributos_con_digitos = ['consumo', 'kilómetros', 'nº_marchas', 'plazas', 'potencia', 'puertas']
+    
+    # Procesar atributos que deben contener dígitos
+    for atributo in atributos_con_digitos:
+        if atributo in vehiculo_procesado:
+            valor = vehiculo_procesado[atributo]
+            if valor and isinstance(valor, str):
+                # Verificar si contiene al menos un dígito
+                if not re.search(r'\d', valor):
+                    del vehiculo_procesado[atributo]
+                else:
+                    # Extraer números y convertir a entero
+                    numeros = re.findall(r'\d+', valor)
+                    if numeros:
+                        vehiculo_procesado[atributo] = int(numeros[0])
+    
+    # Procesar el atributo año
+    if 'año' in vehiculo_procesado:
+        valor_año = vehiculo_procesado['año']
+        if valor_año and isinstance(valor_año, str):
+            numeros_año = re.findall(r'\d+', valor_año)
+            if numeros_año:
+                vehiculo_procesado['año'] = int(numeros_año[0])
+    
+    # Procesar el atributo informacion (lista)
+    if 'informacion' in vehiculo_procesado:
+        info = vehiculo_procesado['informacion']
+        if isinstance(info, list):
+            # Filtrar elementos vacíos de la lista
+            info_filtrada = [item.strip() for item in info if item and item.strip()]
+            if info_filtrada:
+                vehiculo_procesado['informacion'] = info_filtrada
+            else:
+                del vehiculo_procesado['informacion']
+        elif not info:
+            del vehiculo_procesado['informacion']
+    
+    # Procesar el atributo precios (lista)
+    if 'precios' in vehiculo_procesado:
+        precios = vehiculo_procesado['precios']
+        if isinstance(precios, list):
+            # Filtrar elementos que no tengan importe o estén vacíos
+            precios_filtrados = []
+            for precio in precios:
+                if isinstance(precio, dict) and 'importe' in precio and precio['importe'] is not None:
+                    # Verificar que no haya valores vacíos o None en el elemento
+                    tiene_valores_vacios = False
+                    for valor in precio.values():
+                        if valor is None or (isinstance(valor, str) and not valor.strip()) or valor == '':
+                            tiene_valores_vacios = True
+                            break
+                    
+                    if not tiene_valores_vacios:
+                        precios_filtrados.append(precio)
+            
+            if precios_filtrados:
+                vehiculo_procesado['precios'] = precios_filtrados
+            else:
+                del vehiculo_procesado['precios']
+    
+    # Eliminar atributos con valores vacíos o None
+    atributos_a_eliminar = []
+    for clave, valor in vehiculo_procesado.items():
+        if valor is None or (isinstance(valor, str) and not valor.strip()) or valor == '':
+            atributos_a_eliminar.append(clave)
+    
+    for atributo in atributos_a_eliminar:
+        del vehiculo_procesado[atributo]
+    
+    return vehiculo_procesado
+
+
+def descripcion_truncada(html):
+    """
+    Indica si la descripción generada (bloque preDesc-ia > ia-content) tiene el
+    botón 'Ver más'. Solo se construye el árbol del bloque preDesc-ia, y la mayoría
+    de páginas, sin el botón en ninguna parte, se descartan sin parsear.
+    """
+    if b'show-more-btn' not in html:
+        return False
+    # Al filtrar, bs4 compara el atributo class completo, sin separar las clases
+    bloque = SoupStrainer('div', class_=re.compile(r'(^|\s)preDesc-ia(\s|$)'))
+    soup = BeautifulSoup(html, 'html.parser', parse_only=bloque)
+    predesc_ia = soup.find('div', class_='preDesc-ia')
+    if not predesc_ia:
+        return False
+    ia_content = predesc_ia.find('div', class_='ia-content')
+    return bool(ia_content and ia_content.find(id='show-more-btn'))
+
+
+def extraer_descripcion(soup):
+    """Extrae el texto de la descripción generada (bloque preDesc-ia) de la página"""
+    predesc_ia = soup.find('div', class_='preDesc-ia')
+    if not predesc_ia:
+        return ''
+    ia_content = predesc_ia.find('div', class_='ia-content')
+    if not ia_content:
+        return ''
+    # Eliminar etiquetas <strong> y <p> dejando espacios
+    for tag in ia_content.find_all(['strong', 'p']):
+        tag.insert_before(' ')
+        tag.insert_after(' ')
+        tag.unwrap()
+    descripcion = ia_content.get_text()
+    descripcion = re.sub(r'[\s\u00A0]+', ' ', descripcion).strip()
+    return descripcion
+
+
+def construir_documento(crudo):
+    """
+    Construye el documento final del vehículo a partir de la página descargada.
+
+    crudo contiene nombre, url y scraped_at, y opcionalmente:
+    - html: bytes de la página de detalle
+    - html_descripcion: bytes del DOM renderizado con Selenium tras pulsar 'Ver más'
+      (None si la descripción completa ya venía en html)
+    - precios: lista de precios obtenida con Selenium
+    - descripcion: descripción ya extraída (al refrescar un vehículo guardado), que
+      sustituye al parseo de html_descripcion
+    """
+    vehiculo = {
+        'nombre': crudo['nombre'],
+        'url': crudo['url'],
+        'scraped_at': crudo['scraped_at']
+    }
+    html = crudo.get('html')
+    if html is not None:
+        detalle_soup = BeautifulSoup(html, 'html.parser')
+        vehiculo.update(obtener_datos_tecnicos(detalle_soup))
+        vehiculo['informacion'] = obtener_informacion(detalle_soup)
+        html_descripcion = crudo.get('html_descripcion')
+        if 'descripcion' in crudo:
+            vehiculo['descripcion'] = crudo['descripcion']
+        else:
+            if html_descripcion is None:
+                descripcion_soup = detalle_soup
+            else:
+                descripcion_soup = BeautifulSoup(html_descripcion, 'html.parser')
+            vehiculo['descripcion'] = extraer_descripcion(descripcion_soup)
+        vehiculo['etiquetas_ambientales'] = obtener_etiquetas_ambientales(detalle_soup)
+        vehiculo['precios'] = crudo.get('precios', [])
+    return procesar_documento_vehiculo(vehiculo)
+
+
+def construir_documentos(crudos):
+    """Construye un lote de documentos devolviendo pares (documento, texto para embedding)"""
+    resultados = []
+    for crudo in crudos:
+        # Una página mal formada no debe tirar el lote entero
+        try:
+            documento = construir_documento(crudo)
+            resultados.append((documento, generar_texto_documento(documento)))
+        except Exception as e:
+            print(f"Error parseando {crudo.get('url')}: {e}")
+    return resultados
+
+
+def crear_pool(workers=None):
+    """Devuelve un pool de procesos para construir_documentos, o None si se parsea en línea"""
+    workers = parse_workers if workers is None else workers
+    if workers <= 0:
+        return None
+    # fork evita que cada proceso reimporte el script principal (con spawn se volvería a
+    # ejecutar scrapper.py: MongoClient, selenium...). Con fork todos los procesos se
+    # lanzan en el primer submit, que se hace aquí para que ocurra antes de abrir
+    # conexiones o lanzar hilos en el proceso principal.
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    pool.submit(int).result()
+    return pool
+
+
+def construir_en_pool(pool, crudos, chunk=None):
+    """Construye los documentos repartiendo los crudos en lotes de chunk entre los procesos"""
+    chunk = chunk or parse_chunk
+    if pool is None:
+        return construir_documentos(crudos)
+    lotes = [crudos[i:i + chunk] for i in range(0, len(crudos), chunk)]
+    resultados = []
+    for lote in pool.map(construir_documentos, lotes):
+        resultados.extend(lote)
+    return resultados
+
+
+def generar_texto_documento(doc):
+    # Apartado Vehículo y URL
+    texto = f"Vehículo: {doc.get('nombre', 'No disponible')}\n"
+    texto += f"Url: {doc.get('url', 'No disponible')}\n"
+    
+    precios = doc.get("precios", [])
+    precio_min = None
+    if precios:
+        precio_min = min(precios, key=lambda p: p["importe"])
+    texto += f"Precio: {precio_min['importe']}€/mes durante {precio_min['duracion']} meses y {precio_min['kms']} km/año\n\n" if precio_min else '\n'
+        
+    
+    # Apartado Descripción
+    texto += "Descripción:\n"
+    texto += f"{doc.get('descripcion', 'No disponible')}\n\n"
+    
+    # Apartado Información General
+    texto += "Información General:\n"
+    for item in doc.get('informacion', []):
+        texto += f"- {item}\n"
+    texto += "\n"
+
+    # Apartado Datos técnicos
+    texto += "Datos técnicos:\n"
+    campos_excluidos = ['_id', 'scraped_at', 'informacion', 'descripcion', 'nombre', 'url', 'precios', 'embedding', 'similares']
+
+    # Orden fijo de los campos: un campo añadido después con $set queda al final del
+    # documento en Mongo y, si no, el texto cambiaría solo por el orden de las claves
+    for clave in sorted(doc):
+        valor = doc[clave]
+        if clave in campos_excluidos:
+            continue
+
+        # Omitir si el valor es 'no disponible'
+        if isinstance(valor, str) and valor.lower() == 'no disponible':
+            continue
+
+        # Control de campos numéricos o condicionales
+        if clave in ['consumo', 'kilómetros', 'nº_marchas', 'plazas', 'potencia', 'puertas', 'precios']:
+            if not any(char.isdigit() for char in str(valor)):
+                continue
+
+        # Normalizar clave para texto
+        clave_texto = clave.replace('_', ' ').capitalize()
+        texto += f"{clave_texto}: {valor}\n"
+
+    return texto
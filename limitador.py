@@ -0,0 +1,207 @@
+import os
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+
+# Configuración del limitador (peticiones por segundo por host)
+TASA_INICIAL = float(os.getenv('SCRAPER_TASA_INICIAL', '4'))
+TASA_MIN = float(os.getenv('SCRAPER_TASA_MIN', '0.2'))
+TASA_MAX = float(os.getenv('SCRAPER_TASA_MAX', '20'))
+CONCURRENCIA_MAX = int(os.getenv('SCRAPER_CONCURRENCIA_MAX', '8'))
+# Latencia (segundos) a partir de la cual se considera que el servidor va lento
+LATENCIA_OBJETIVO = float(os.getenv('SCRAPER_LATENCIA_OBJETIVO', '1.5'))
+
+REINTENTOS = 4
+ESPERA_BASE = 1.0
+ESPERA_MAX = 60.0
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+class LimitadorHost:
+    """
+    Token bucket de un host con concurrencia adaptativa (AIMD):
+    - Cada respuesta rápida y correcta sube la tasa un poco y, cada cierto número
+      de éxitos, permite una petición simultánea más.
+    - Un 429/5xx, un error de red o una latencia muy alta reducen a la mitad la
+      tasa y la concurrencia.
+    """
+
+    def __init__(self):
+        self.tasa = TASA_INICIAL
+        self.tokens = 1.0
+        self.ultima_recarga = time.monotonic()
+        self.concurrencia = min(2, CONCURRENCIA_MAX)
+        self.activas = 0
+        self.exitos_seguidos = 0
+        self.bloqueado_hasta = 0.0
+        self.condicion = threading.Condition()
+
+    def _recargar(self, ahora):
+        capacidad = max(1.0, self.tasa)
+        self.tokens = min(capacidad, self.tokens + (ahora - self.ultima_recarga) * self.tasa)
+        self.ultima_recarga = ahora
+
+    def adquirir(self):
+        """Bloquea hasta que haya un token y un hueco de concurrencia libres"""
+        with self.condicion:
+            while True:
+                ahora = time.monotonic()
+                self._recargar(ahora)
+                if ahora < self.bloqueado_hasta:
+                    espera = self.bloqueado_hasta - ahora
+                elif self.activas >= self.concurrencia:
+                    espera = None
+                elif self.tokens < 1.0:
+                    espera = (1.0 - self.tokens) / self.tasa
+                else:
+                    self.tokens -= 1.0
+                    self.activas += 1
+                    return
+                self.condicion.wait(espera)
+
+    def liberar(self, latencia, error=False):
+        """
+        Registra el resultado de la petición y ajusta tasa y concurrencia.
+        Con latencia None (sin medida fiable del servidor) solo se ajusta si hubo error.
+        """
+        with self.condicion:
+            self.activas -= 1
+            if error or (latencia is not None and latencia > 2 * LATENCIA_OBJETIVO):
+                self.tasa = max(TASA_MIN, self.tasa / 2)
+                self.concurrencia = max(1, self.concurrencia // 2)
+                self.exitos_seguidos = 0
+            elif latencia is not None and latencia <= LATENCIA_OBJETIVO:
+                self.tasa = min(TASA_MAX, self.tasa + 0.5)
+                self.exitos_seguidos += 1
+                if self.exitos_seguidos >= 10:
+                    self.concurrencia = min(CONCURRENCIA_MAX, self.concurrencia + 1)
+                    self.exitos_seguidos = 0
+            self.condicion.notify_all()
+
+    def pausar(self, segundos):
+        """Detiene todas las peticiones al host durante los segundos indicados"""
+        with self.condicion:
+            self.bloqueado_hasta = max(self.bloqueado_hasta, time.monotonic() + segundos)
+            self.condicion.notify_all()
+
+
+_limitadores = {}
+_limitadores_lock = threading.Lock()
+
+
+def obtener_limitador(url):
+    host = urlparse(url).netloc
+    with _limitadores_lock:
+        if host not in _limitadores:
+            _limitadores[host] = LimitadorHost()
+        return _limitadores[host]
+
+
+def leer_retry_after(valor):
+    """Convierte la cabecera Retry-After (segundos o fecha HTTP) en segundos de espera"""
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        fecha = parsedate_to_datetime(valor)
+    except (TypeError, ValueError):
+        return None
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return max(0.0, (fecha - datetime.now(timezone.utc)).total_seconds())
+
+
+def calcular_espera(intento, retry_after=None):
+    """Backoff exponencial con jitter completo; Retry-After tiene prioridad si viene"""
+    if retry_after is not None:
+        return min(ESPERA_MAX, retry_after) + random.uniform(0, ESPERA_BASE)
+    return random.uniform(0, min(ESPERA_MAX, ESPERA_BASE * 2 ** intento))
+
+
+def peticion_get(url, reintentos=REINTENTOS, **kwargs):
+    """
+    requests.get limitado por host. Reintenta los 429/5xx y los errores de red con
+    backoff; si se agotan los reintentos devuelve la última respuesta o relanza
+    la última excepción.
+    """
+    kwargs.setdefault('timeout', 30)
+    limitador = obtener_limitador(url)
+    for intento in range(reintentos + 1):
+        limitador.adquirir()
+        inicio = time.monotonic()
+        try:
+            response = requests.get(url, **kwargs)
+        except requests.RequestException:
+            limitador.liberar(time.monotonic() - inicio, error=True)
+            if intento == reintentos:
+                raise
+            time.sleep(calcular_espera(intento))
+            continue
+
+        error = response.status_code in ESTADOS_REINTENTABLES
+        limitador.liberar(time.monotonic() - inicio, error=error)
+        if not error or intento == reintentos:
+            return response
+
+        retry_after = leer_retry_after(response.headers.get('Retry-After'))
+        espera = calcular_espera(intento, retry_after)
+        if retry_after is not None:
+            limitador.pausar(espera)
+        print(f"Respuesta {response.status_code} en {url}, reintentando en {espera:.1f}s...")
+        time.sleep(espera)
+
+
+def latencia_servidor(driver):
+    """
+    Tiempo (segundos) que tardó el servidor en empezar a responder al documento
+    cargado, según performance.timing; None si el navegador no lo expone.
+    """
+    try:
+        milisegundos = driver.execute_script(
+            "var t = window.performance && performance.timing;"
+            "return t ? t.responseStart - t.requestStart : null;"
+        )
+    except Exception:
+        return None
+    if milisegundos is None or milisegundos < 0:
+        return None
+    return milisegundos / 1000
+
+
+def cargar_pagina(driver, url):
+    """
+    driver.get limitado por el mismo token bucket que las peticiones HTTP. La
+    latencia que se usa para adaptar la tasa es la del servidor, no la del
+    renderizado completo (que incluye recursos de terceros).
+    """
+    limitador = obtener_limitador(url)
+    limitador.adquirir()
+    inicio = time.monotonic()
+    try:
+        driver.get(url)
+    except Exception:
+        limitador.liberar(time.monotonic() - inicio, error=True)
+        raise
+    limitador.liberar(latencia_servidor(driver))
+
+
+def esperar_turno(url, accion):
+    """
+    Ejecuta una acción que puede generar tráfico contra el host (p. ej. un clic que
+    lanza una petición AJAX) consumiendo un token del limitador. Su duración
+    incluye trabajo del navegador, así que no se usa para adaptar la tasa.
+    """
+    limitador = obtener_limitador(url)
+    limitador.adquirir()
+    try:
+        return accion()
+    finally:
+        limitador.liberar(None)
@@ -0,0 +1,82 @@
+"""
+Reconstruye todos los documentos de vehículos a partir del archivo de páginas
+(SCRAPER_ARCHIVO), sin red ni Selenium, aplicando la lógica de extracción actual.
+
+Qué vehículos cubre: los que tienen algún registro en el archivo, es decir, los
+descargados en alguna ejecución del scraper con SCRAPER_ARCHIVO definido (se usa
+el registro más reciente de cada URL). Por defecto el scraper solo descarga los
+vehículos nuevos; para cubrir el catálogo publicado en ese momento hace falta una
+ejecución con SCRAPER_REFRESCAR=1 y el archivo activo. Los coches que solo están
+en Mongo (retirados de la web antes de activar el archivo, o no descargados desde
+entonces) no se tocan.
+
+Un registro del archivo nunca sustituye a un documento más reciente: si el
+scraped_at guardado en Mongo es posterior al del registro (p. ej. porque el coche
+se refrescó en una ejecución sin archivo), ese coche se deja como está para no
+volver a precios o datos anteriores.
+
+Los campos que la extracción actual ya no produce se eliminan del documento, y
+solo se recalcula el embedding de los vehículos cuyo texto de
+generar_texto_documento ha cambiado; el resto reutiliza el guardado.
+
+    SCRAPER_ARCHIVO=archivo/ python reextraer.py --workers 4
+"""
+import time
+import argparse
+from archivo import archivo_activo, leer_crudos
+from extraccion import crear_pool, construir_en_pool, parse_workers, parse_chunk
+from scrapper import guardar_resultados, calcular_vecinos, coleccion
+from snapshot import directorio_snapshot, exportar_snapshot
+
+# URLs por consulta al leer de Mongo los documentos guardados
+BLOQUE_CONSULTA = 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-extracción offline de vehículos desde el archivo')
+    parser.add_argument('--workers', type=int, default=parse_workers,
+                        help='Procesos para el parseo (0 = en el propio proceso)')
+    parser.add_argument('--chunk', type=int, default=parse_chunk, help='Vehículos por tarea enviada al pool')
+    args = parser.parse_args()
+
+    if not archivo_activo():
+        print('SCRAPER_ARCHIVO no está definido, no hay archivo que re-extraer.')
+        return
+
+    inicio = time.perf_counter()
+    crudos = leer_crudos()
+    print(f"Vehículos en el archivo: {len(crudos)}")
+
+    pool = crear_pool(args.workers)
+    try:
+        resultados = construir_en_pool(pool, crudos, args.chunk)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print(f"Documentos reconstruidos en {time.perf_counter() - inicio:.1f}s")
+
+    urls = [vehiculo['url'] for vehiculo, _ in resultados]
+    vehiculos_db = dict.fromkeys(urls)
+    for i in range(0, len(urls), BLOQUE_CONSULTA):
+        for vehiculo_db in coleccion.find({'url': {'$in': urls[i:i + BLOQUE_CONSULTA]}}):
+            vehiculos_db[vehiculo_db['url']] = vehiculo_db
+
+    vigentes = []
+    for vehiculo, texto in resultados:
+        vehiculo_db = vehiculos_db[vehiculo['url']]
+        if vehiculo_db and vehiculo_db.get('scraped_at', '') > vehiculo['scraped_at']:
+            del vehiculos_db[vehiculo['url']]
+            continue
+        vigentes.append((vehiculo, texto))
+    if len(vigentes) < len(resultados):
+        print(f"Omitidos {len(resultados) - len(vigentes)} vehículos con datos en Mongo más recientes que el archivo")
+
+    total = guardar_resultados(vigentes, vehiculos_db, registrar_precios=False)
+    print(f"Re-extracción completada. Total de coches procesados: {total} en {time.perf_counter() - inicio:.1f}s")
+    calcular_vecinos()
+    if directorio_snapshot:
+        exportar_snapshot(coleccion)
+
+
+if __name__ == "__main__":
+    main()
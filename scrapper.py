@@ -1,10 +1,12 @@
-import requests
 from bs4 import BeautifulSoup
-import time
 import re
 import os
+import queue
+import threading
 import openai
+import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -12,8 +14,15 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from dotenv import load_dotenv
+from limitador import peticion_get, cargar_pagina, esperar_turno
+from extraccion import (
+    generar_texto_documento, construir_documentos, crear_pool, parse_chunk,
+    descripcion_truncada
+)
+from archivo import archivar_pagina, archivar_crudo
+from snapshot import directorio_snapshot, exportar_snapshot
 
 load_dotenv()
 
@@ -24,196 +33,108 @@ headers = {
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+# Número de páginas de listado que se descargan en paralelo
+listado_workers = int(os.getenv('SCRAPER_LISTADO_WORKERS', '4'))
+# Segundos que se espera, antes de leer cada precio, a que cambie tras seleccionar el kilometraje
+espera_cambio_precio = float(os.getenv('SCRAPER_ESPERA_PRECIO', '1'))
+# Con SCRAPER_REFRESCAR=1 también se vuelven a scrapear (precios y datos) los vehículos
+# que ya están en la base de datos; por defecto solo se scrapean los nuevos
+refrescar_existentes = os.getenv('SCRAPER_REFRESCAR', '0') == '1'
+# Número de vehículos similares que se precalculan para cada coche. Es una lista de
+# candidatos: buscar_similares filtra por precio y contrato y luego recorta al límite
+numero_vecinos = int(os.getenv('SCRAPER_VECINOS', '50'))
+
 # Conexión a MongoDB
 mongo_uri = os.getenv('SCRAPER_MONGO_URI') or os.getenv('MONGO_URI')
-mongo_client = MongoClient(mongo_uri)
+# connect=False: sin conexión ni hilos hasta la primera operación, para poder crear
+# antes el pool de procesos de extraccion (que usa fork)
+mongo_client = MongoClient(mongo_uri, connect=False)
 
 db = mongo_client['vehiculos']
 coleccion = db['vehiculos']
+coleccion_historial_precios = db['historial_precios']
+
+# Campos que no salen del scraping y no deben borrarse al guardar un vehículo
+CAMPOS_NO_SCRAPEADOS = ['_id', 'embedding', 'similares']
+# Valor por defecto para indicar que el documento guardado aún no se ha consultado
+SIN_CONSULTAR = object()
+
+def clic_y_esperar(driver, elemento, url):
+    """Hace clic en un elemento y espera a que terminen las peticiones AJAX que lance"""
+    def accion():
+        driver.execute_script("arguments[0].click();", elemento)
+        WebDriverWait(driver, 10).until(
+            lambda d: d.execute_script("return !window.jQuery || jQuery.active === 0")
+        )
+    esperar_turno(url, accion)
 
-def obtener_datos_tecnicos(soup):
-    datos = {}
-    propiedades = soup.find_all('div', class_='car-property')
-    for prop in propiedades:
-        spans = prop.find_all(['span', 'strong'])
-        if len(spans) >= 2:
-            clave = spans[0].get_text(strip=True).lower().replace(' ', '_')
-            valor = spans[1].get_text(strip=True)
-            datos[clave] = valor
-    return datos
-
-
-def obtener_informacion(soup):
-    info_parrafos = []
-    predesc = soup.find('div', class_='preDesc')
-    if predesc:
-        parrafos = predesc.find_all('p')
-        for p in parrafos:
-            for strong in p.find_all('strong'):
-                strong.insert_before(' ')
-                strong.insert_after(' ')
-                strong.unwrap()
-            texto = p.get_text()
-            texto = re.sub(r'[\s\u00A0]+', ' ', texto).strip()
-            if texto:
-                info_parrafos.append(texto)
-    return info_parrafos
-
-
-def obtener_etiquetas_ambientales(soup):
-    """Extrae las etiquetas ambientales del vehículo"""
-    etiqueta_container = soup.find('div', class_='etiqueta-combinada-container')
-    if not etiqueta_container:
-        return None
-    
-    # Buscar la imagen de la etiqueta ambiental
-    img_etiqueta = etiqueta_container.find('img', class_='environmental-label')
-    if not img_etiqueta:
-        return None
-    
-    # Extraer el valor del atributo alt de la imagen
-    alt_text = img_etiqueta.get('alt', '')
-    return alt_text if alt_text else None
 
+def leer_texto_precio(driver):
+    """Texto actual del precio del formulario de variaciones ('' si no está)"""
+    try:
+        span_precio = driver.find_element(By.CSS_SELECTOR, '.boton-form-desktop .span-price')
+        return (span_precio.get_attribute('textContent') or '').strip()
+    except NoSuchElementException:
+        return ''
 
-def procesar_documento_vehiculo(vehiculo):
-    """Procesa el documento del vehículo antes de guardarlo en MongoDB"""
-    
-    # Crear una copia del documento para no modificar el original
-    vehiculo_procesado = vehiculo.copy()
-    
-    # Lista de atributos que deben contener al menos un dígito
-    atributos_con_digitos = ['consumo', 'kilómetros', 'nº_marchas', 'plazas', 'potencia', 'puertas']
-    
-    # Procesar atributos que deben contener dígitos
-    for atributo in atributos_con_digitos:
-        if atributo in vehiculo_procesado:
-            valor = vehiculo_procesado[atributo]
-            if valor and isinstance(valor, str):
-                # Verificar si contiene al menos un dígito
-                if not re.search(r'\d', valor):
-                    del vehiculo_procesado[atributo]
-                else:
-                    # Extraer números y convertir a entero
-                    numeros = re.findall(r'\d+', valor)
-                    if numeros:
-                        vehiculo_procesado[atributo] = int(numeros[0])
-    
-    # Procesar el atributo año
-    if 'año' in vehiculo_procesado:
-        valor_año = vehiculo_procesado['año']
-        if valor_año and isinstance(valor_año, str):
-            numeros_año = re.findall(r'\d+', valor_año)
-            if numeros_año:
-                vehiculo_procesado['año'] = int(numeros_año[0])
-    
-    # Procesar el atributo informacion (lista)
-    if 'informacion' in vehiculo_procesado:
-        info = vehiculo_procesado['informacion']
-        if isinstance(info, list):
-            # Filtrar elementos vacíos de la lista
-            info_filtrada = [item.strip() for item in info if item and item.strip()]
-            if info_filtrada:
-                vehiculo_procesado['informacion'] = info_filtrada
-            else:
-                del vehiculo_procesado['informacion']
-        elif not info:
-            del vehiculo_procesado['informacion']
-    
-    # Procesar el atributo precios (lista)
-    if 'precios' in vehiculo_procesado:
-        precios = vehiculo_procesado['precios']
-        if isinstance(precios, list):
-            # Filtrar elementos que no tengan importe o estén vacíos
-            precios_filtrados = []
-            for precio in precios:
-                if isinstance(precio, dict) and 'importe' in precio and precio['importe'] is not None:
-                    # Verificar que no haya valores vacíos o None en el elemento
-                    tiene_valores_vacios = False
-                    for valor in precio.values():
-                        if valor is None or (isinstance(valor, str) and not valor.strip()) or valor == '':
-                            tiene_valores_vacios = True
-                            break
-                    
-                    if not tiene_valores_vacios:
-                        precios_filtrados.append(precio)
-            
-            if precios_filtrados:
-                vehiculo_procesado['precios'] = precios_filtrados
-            else:
-                del vehiculo_procesado['precios']
-    
-    # Eliminar atributos con valores vacíos o None
-    atributos_a_eliminar = []
-    for clave, valor in vehiculo_procesado.items():
-        if valor is None or (isinstance(valor, str) and not valor.strip()) or valor == '':
-            atributos_a_eliminar.append(clave)
-    
-    for atributo in atributos_a_eliminar:
-        del vehiculo_procesado[atributo]
-    
-    return vehiculo_procesado
 
+def seleccionar_variacion(driver, elemento, url):
+    """Selecciona una variación (duración o kilometraje) y espera a que quede marcada"""
+    if 'selected' in (elemento.get_attribute('class') or '').split():
+        return
+    clic_y_esperar(driver, elemento, url)
+    WebDriverWait(driver, 10).until(
+        lambda d: 'selected' in (elemento.get_attribute('class') or '').split()
+    )
 
-def obtener_descripcion(url, headers):
-    # Usar requests para obtener la página primero
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        return ''
-    soup = BeautifulSoup(response.text, 'html.parser')
-    predesc_ia = soup.find('div', class_='preDesc-ia')
-    if not predesc_ia:
-        return ''
-    ia_content = predesc_ia.find('div', class_='ia-content')
-    if not ia_content:
-        return ''
-    # Comprobar si existe el botón 'Ver más'
-    show_more = ia_content.find(id='show-more-btn')
-    if show_more:
-        # Usar Selenium para obtener el texto completo
+
+def esperar_cambio_precio(driver, precio_previo):
+    """
+    Espera a que el precio mostrado deje de ser precio_previo. Si la combinación
+    cuesta lo mismo el precio no cambia, por eso la espera es corta y no es un
+    error; solo se hace antes de leer un precio.
+    """
+    try:
+        WebDriverWait(driver, espera_cambio_precio).until(
+            lambda d: leer_texto_precio(d) != precio_previo
+        )
+    except TimeoutException:
+        pass
+
+
+def obtener_html_descripcion(url, html):
+    """
+    Devuelve el DOM renderizado con Selenium tras pulsar 'Ver más' cuando la
+    descripción está truncada, o None si la descripción completa ya está en html.
+    """
+    # El parseo completo de la página se hace en construir_documento
+    if not descripcion_truncada(html):
+        return None
+    # Usar Selenium para obtener el texto completo
+    try:
+        options = webdriver.ChromeOptions()
+        options.add_argument('--headless')
+        options.add_argument('--no-sandbox')
+        options.add_argument('--disable-dev-shm-usage')
+        options.add_argument('--disable-blink-features=AutomationControlled')
+        options.add_argument('--disable-extensions')
+        options.add_argument('--disable-gpu')
+        options.add_argument('--remote-debugging-port=9222')
+        service = Service(ChromeDriverManager().install())
+        driver = webdriver.Chrome(service=service, options=options)
+        cargar_pagina(driver, url)
+        wait = WebDriverWait(driver, 10)
         try:
-            options = webdriver.ChromeOptions()
-            options.add_argument('--headless')
-            options.add_argument('--no-sandbox')
-            options.add_argument('--disable-dev-shm-usage')
-            options.add_argument('--disable-blink-features=AutomationControlled')
-            options.add_argument('--disable-extensions')
-            options.add_argument('--disable-gpu')
-            options.add_argument('--remote-debugging-port=9222')
-            options.add_argument('--disable-blink-features=AutomationControlled')
-            options.add_argument('--disable-extensions')
-            options.add_argument('--disable-gpu')
-            options.add_argument('--remote-debugging-port=9222')
-            service = Service(ChromeDriverManager().install())
-            driver = webdriver.Chrome(service=service, options=options)
-            driver.get(url)
-            wait = WebDriverWait(driver, 10)
-            try:
-                ver_mas = wait.until(EC.element_to_be_clickable((By.ID, 'show-more-btn')))
-                ver_mas.click()
-                time.sleep(0.2)  # Esperar a que se expanda el texto
-            except (TimeoutException, NoSuchElementException):
-                pass
-            html_actualizado = driver.page_source
-            driver.quit()
-            soup = BeautifulSoup(html_actualizado, 'html.parser')
-            predesc_ia = soup.find('div', class_='preDesc-ia')
-            if not predesc_ia:
-                return ''
-            ia_content = predesc_ia.find('div', class_='ia-content')
-            if not ia_content:
-                return ''
-        except Exception as e:
-            print(f"Error con Selenium en {url}: {e}")
-            return ''
-    # Eliminar etiquetas <strong> y <p> dejando espacios
-    for tag in ia_content.find_all(['strong', 'p']):
-        tag.insert_before(' ')
-        tag.insert_after(' ')
-        tag.unwrap()
-    descripcion = ia_content.get_text()
-    descripcion = re.sub(r'[\s\u00A0]+', ' ', descripcion).strip()
-    return descripcion
+            ver_mas = wait.until(EC.element_to_be_clickable((By.ID, 'show-more-btn')))
+            clic_y_esperar(driver, ver_mas, url)  # Esperar a que se expanda el texto
+        except (TimeoutException, NoSuchElementException):
+            pass
+        html_actualizado = driver.page_source
+        driver.quit()
+        return html_actualizado.encode('utf-8')
+    except Exception as e:
+        print(f"Error con Selenium en {url}: {e}")
+        return b''
 
 
 def extraer_precio_numerico(texto_precio):
@@ -236,32 +157,39 @@ def obtener_precios_combinaciones(url):
         options.add_argument('--no-sandbox')
         options.add_argument('--disable-dev-shm-usage')
         driver = webdriver.Chrome(options=options)
-        driver.get(url)
+        cargar_pagina(driver, url)
         wait = WebDriverWait(driver, 10)
 
         # Esperar a que se cargue el formulario de variaciones
         wait.until(EC.presence_of_element_located((By.CLASS_NAME, 'variations_form')))
+        archivar_pagina(url, driver.page_source.encode('utf-8'), 'precios')
 
         # Obtener los valores posibles de duración y kilometraje
         duraciones = [li.get_attribute('data-value') for li in driver.find_elements(By.CSS_SELECTOR, 'ul[data-id="duracion"] li.variable-item')]
         kilometrajes = [li.get_attribute('data-value') for li in driver.find_elements(By.CSS_SELECTOR, 'ul[data-id="km"] li.variable-item')]
 
         for duracion in duraciones:
-            # Selecciona la duración
-            li_duracion = driver.find_element(By.CSS_SELECTOR, f'ul[data-id="duracion"] li.variable-item[data-value="{duracion}"]')
-            driver.execute_script("arguments[0].click();", li_duracion)
-            time.sleep(0.2)
-            # Siempre selecciona el primer kilometraje para forzar el reset
-            if kilometrajes:
-                li_km_reset = driver.find_element(By.CSS_SELECTOR, f'ul[data-id=\"km\"] li.variable-item[data-value=\"{kilometrajes[0]}\"]')
-                driver.execute_script("arguments[0].click();", li_km_reset)
-                time.sleep(0.2)
+            try:
+                precio_previo = leer_texto_precio(driver)
+                # Selecciona la duración
+                li_duracion = driver.find_element(By.CSS_SELECTOR, f'ul[data-id="duracion"] li.variable-item[data-value="{duracion}"]')
+                seleccionar_variacion(driver, li_duracion, url)
+                # Siempre selecciona el primer kilometraje para forzar el reset
+                if kilometrajes:
+                    li_km_reset = driver.find_element(By.CSS_SELECTOR, f'ul[data-id=\"km\"] li.variable-item[data-value=\"{kilometrajes[0]}\"]')
+                    seleccionar_variacion(driver, li_km_reset, url)
+            except Exception as e:
+                # Sin la duración seleccionada no se pueden leer sus precios; se omiten
+                print(f"Error seleccionando la duración {duracion} en {url}: {e}")
+                continue
             for kilometraje in kilometrajes:
                 try:
                     # Selecciona el kilometraje
                     li_km = driver.find_element(By.CSS_SELECTOR, f'ul[data-id=\"km\"] li.variable-item[data-value=\"{kilometraje}\"]')
-                    driver.execute_script("arguments[0].click();", li_km)
-                    time.sleep(0.2)
+                    if 'selected' not in (li_km.get_attribute('class') or '').split():
+                        precio_previo = leer_texto_precio(driver)
+                    seleccionar_variacion(driver, li_km, url)
+                    esperar_cambio_precio(driver, precio_previo)
 
                     # Esperar a que el botón esté presente y visible
                     wait.until(EC.presence_of_element_located((By.CLASS_NAME, 'boton-form-desktop')))
@@ -300,19 +228,30 @@ def obtener_precios_combinaciones(url):
     return precios
 
 
-def obtener_datos_vehiculo(coche):
+def descargar_vehiculo(coche):
+    """
+    Descarga todo lo necesario para construir el documento del vehículo (HTML de
+    detalle, DOM de la descripción y precios) sin parsearlo; el parseo se hace en
+    extraccion.construir_documento, opcionalmente en un pool de procesos.
+    Devuelve (crudo, documento guardado en Mongo o None), o (None, None) si el
+    vehículo ya existe y no se están refrescando los existentes o el refresco ha
+    quedado incompleto (ver refresco_completo).
+
+    Al refrescar un vehículo que ya tiene descripción no se vuelve a renderizar con
+    Selenium: se reutiliza la guardada y solo se actualizan página y precios.
+    """
     titulo_elem = coche.find('h2', class_='card-title')
     titulo = titulo_elem.get_text(strip=True) if titulo_elem else 'no disponible'
 
     enlace_elem = coche.find('a', class_='enlace-car')
     enlace = enlace_elem['href'] if enlace_elem else 'no disponible'
 
-    # Para escrapear solo nuevos vehículos
-    vehiculo_encontrado = coleccion.find_one({'url': enlace})
-    if vehiculo_encontrado:
-        return None
+    vehiculo_db = coleccion.find_one({'url': enlace})
+    # Sin SCRAPER_REFRESCAR=1 se scrapean solo los vehículos nuevos
+    if vehiculo_db and not refrescar_existentes:
+        return None, None
 
-    vehiculo = {
+    crudo = {
         'nombre': titulo,
         'url': enlace,
         'scraped_at': datetime.now().isoformat()
@@ -320,83 +259,176 @@ def obtener_datos_vehiculo(coche):
 
     if enlace != 'no disponible':
         try:
-            response = requests.get(enlace, headers=headers)
+            response = peticion_get(enlace, headers=headers)
             if response.status_code == 200:
-                detalle_soup = BeautifulSoup(response.text, 'html.parser')
-                vehiculo.update(obtener_datos_tecnicos(detalle_soup))
-                vehiculo['informacion'] = obtener_informacion(detalle_soup)
-                vehiculo['descripcion'] = obtener_descripcion(enlace, headers)
-                vehiculo['etiquetas_ambientales'] = obtener_etiquetas_ambientales(detalle_soup)
-                
+                html = response.content
+                if vehiculo_db and vehiculo_db.get('descripcion'):
+                    html_descripcion = None
+                    crudo['descripcion'] = vehiculo_db['descripcion']
+                else:
+                    html_descripcion = obtener_html_descripcion(enlace, html)
+
                 # Obtener todos los precios por combinaciones
                 print(f"Obteniendo precios para {titulo}...")
-                vehiculo['precios'] = obtener_precios_combinaciones(enlace)
-                
+                precios = obtener_precios_combinaciones(enlace)
+
+                crudo['html'] = html
+                crudo['html_descripcion'] = html_descripcion
+                crudo['precios'] = precios
         except Exception as e:
             print(f"Error obteniendo datos técnicos o información de {enlace}: {e}")
-    
-    return vehiculo
+
+    if vehiculo_db and not refresco_completo(crudo, vehiculo_db):
+        print(f"Refresco incompleto de {enlace}, se conserva el documento guardado.")
+        return None, None
+
+    archivar_crudo(crudo)
+    return crudo, vehiculo_db
+
+
+def refresco_completo(crudo, vehiculo_db):
+    """
+    Indica si lo descargado al refrescar un vehículo guardado es fiable para
+    sustituirlo. Los fallos de Selenium no se propagan (precios vacíos o con menos
+    combinaciones, DOM de la descripción vacío); si se guardaran, el $unset de
+    guardar_en_mongodb borraría precios o descripción de un coche que sigue igual.
+    """
+    if 'html' not in crudo:
+        return False
+    if crudo.get('html_descripcion') == b'':
+        return False
+    return len(crudo.get('precios', [])) >= len(vehiculo_db.get('precios', []))
+
+
+def preparar_historial_precios():
+    """Crea la colección time-series del historial de precios si no existe"""
+    if 'historial_precios' in db.list_collection_names():
+        return
+    db.create_collection(
+        'historial_precios',
+        timeseries={'timeField': 'fecha', 'metaField': 'meta', 'granularity': 'hours'}
+    )
+    coleccion_historial_precios.create_index([('meta.url', 1), ('meta.duracion', 1), ('meta.kms', 1), ('fecha', 1)])
+
+
+def calcular_cambios(vehiculo, vehiculo_db):
+    """
+    Compara el vehículo con el documento guardado y devuelve (cambios, eliminados):
+    los campos cuyo valor difiere y los campos guardados que ya no tiene el vehículo.
+    """
+    if not vehiculo_db:
+        return dict(vehiculo), []
+    cambios = {}
+    for clave, valor in vehiculo.items():
+        if clave == '_id':
+            continue
+        if clave not in vehiculo_db or vehiculo_db[clave] != valor:
+            cambios[clave] = valor
+    eliminados = [
+        clave for clave in vehiculo_db
+        if clave not in vehiculo and clave not in CAMPOS_NO_SCRAPEADOS
+    ]
+    return cambios, eliminados
+
+
+def obtener_cambios_precios(vehiculo, vehiculo_db):
+    """Devuelve los precios nuevos o modificados respecto al documento guardado"""
+    precios_db = {}
+    for precio in (vehiculo_db or {}).get('precios', []):
+        precios_db[(precio.get('duracion'), precio.get('kms'))] = precio.get('importe')
+
+    cambios = []
+    for precio in vehiculo.get('precios', []):
+        clave = (precio.get('duracion'), precio.get('kms'))
+        if clave not in precios_db or precios_db[clave] != precio.get('importe'):
+            cambios.append(precio)
+    return cambios
+
+
+def precios_sin_historial(url, cambios_precios, vehiculo_db):
+    """
+    Precios guardados que van a ser sustituidos y aún no tienen ninguna entrada en
+    historial_precios (vehículos scrapeados antes de que existiera el historial).
+    Se registran con el scraped_at del documento para no perder el precio anterior.
+    """
+    precios_db = {}
+    for precio in (vehiculo_db or {}).get('precios', []):
+        precios_db[(precio.get('duracion'), precio.get('kms'))] = precio
+    sustituidos = [
+        precios_db[(p['duracion'], p['kms'])] for p in cambios_precios
+        if (p['duracion'], p['kms']) in precios_db
+    ]
+    if not sustituidos:
+        return []
+    con_historial = {
+        (meta['duracion'], meta['kms'])
+        for meta in coleccion_historial_precios.distinct('meta', {'meta.url': url})
+    }
+    return [p for p in sustituidos if (p['duracion'], p['kms']) not in con_historial]
 
 
-def guardar_en_mongodb(vehiculo):
+def registrar_historial_precios(url, precios, fecha):
+    """Añade los cambios de precio a la colección time-series historial_precios"""
+    if not precios:
+        return
+    registros = []
+    for precio in precios:
+        registro = {
+            'meta': {
+                'url': url,
+                'duracion': precio['duracion'],
+                'kms': precio['kms']
+            },
+            'fecha': fecha,
+            'importe': precio['importe']
+        }
+        if 'importe_anterior' in precio:
+            registro['importe_anterior'] = precio['importe_anterior']
+        registros.append(registro)
+    coleccion_historial_precios.insert_many(registros, ordered=False)
+
+
+def guardar_en_mongodb(vehiculo, vehiculo_db=SIN_CONSULTAR, registrar_precios=True):
+    """
+    Guarda el vehículo escribiendo solo los campos que han cambiado respecto al
+    documento almacenado (vehiculo_db, que se consulta si no se pasa) y eliminando
+    los que ya no tiene. Registra los cambios de precio en historial_precios
+    (salvo con registrar_precios=False, p. ej. al re-extraer desde el archivo,
+    donde los precios no son observaciones nuevas).
+    """
     url = vehiculo.get('url')
     if not url:
         print('Vehículo sin URL, no se puede guardar en MongoDB.')
         return
+    if vehiculo_db is SIN_CONSULTAR:
+        vehiculo_db = coleccion.find_one({'url': url})
+
+    if registrar_precios:
+        cambios_precios = obtener_cambios_precios(vehiculo, vehiculo_db)
+        anteriores = precios_sin_historial(url, cambios_precios, vehiculo_db)
+        if anteriores:
+            registrar_historial_precios(url, anteriores, datetime.fromisoformat(vehiculo_db['scraped_at']))
+        registrar_historial_precios(url, cambios_precios, datetime.now())
+
+    cambios, eliminados = calcular_cambios(vehiculo, vehiculo_db)
+    # scraped_at cambia en cada ejecución; por sí solo no justifica reescribir el documento
+    if vehiculo_db and set(cambios) <= {'scraped_at'} and not eliminados:
+        print(f"Vehículo sin cambios: {url}")
+        return
+
+    actualizacion = {'$set': cambios}
+    if eliminados:
+        actualizacion['$unset'] = {clave: '' for clave in eliminados}
     resultado = coleccion.update_one(
         {'url': url},
-        {'$set': vehiculo},
+        actualizacion,
         upsert=True
     )
     if resultado.matched_count == 0:
         print(f"Vehículo nuevo insertado: {url}")
     else:
-        print(f"Vehículo actualizado: {url}")
-
-def generar_texto_documento(doc):
-    # Apartado Vehículo y URL
-    texto = f"Vehículo: {doc.get('nombre', 'No disponible')}\n"
-    texto += f"Url: {doc.get('url', 'No disponible')}\n"
-    
-    precios = doc.get("precios", [])
-    precio_min = None
-    if precios:
-        precio_min = min(precios, key=lambda p: p["importe"])
-    texto += f"Precio: {precio_min['importe']}€/mes durante {precio_min['duracion']} meses y {precio_min['kms']} km/año\n\n" if precio_min else '\n'
-        
-    
-    # Apartado Descripción
-    texto += "Descripción:\n"
-    texto += f"{doc.get('descripcion', 'No disponible')}\n\n"
-    
-    # Apartado Información General
-    texto += "Información General:\n"
-    for item in doc.get('informacion', []):
-        texto += f"- {item}\n"
-    texto += "\n"
-
-    # Apartado Datos técnicos
-    texto += "Datos técnicos:\n"
-    campos_excluidos = ['_id', 'scraped_at', 'informacion', 'descripcion', 'nombre', 'url', 'precios', 'embedding']
-
-    for clave, valor in doc.items():
-        if clave in campos_excluidos:
-            continue
-
-        # Omitir si el valor es 'no disponible'
-        if isinstance(valor, str) and valor.lower() == 'no disponible':
-            continue
-
-        # Control de campos numéricos o condicionales
-        if clave in ['consumo', 'kilómetros', 'nº_marchas', 'plazas', 'potencia', 'puertas', 'precios']:
-            if not any(char.isdigit() for char in str(valor)):
-                continue
-
-        # Normalizar clave para texto
-        clave_texto = clave.replace('_', ' ').capitalize()
-        texto += f"{clave_texto}: {valor}\n"
-
-    return texto
+        print(f"Vehículo actualizado ({', '.join(sorted(cambios))}"
+              f"{'; eliminados: ' + ', '.join(sorted(eliminados)) if eliminados else ''}): {url}")
 
 def obtener_embeddings(texto):
     embedding = None
@@ -412,10 +444,10 @@ def obtener_embeddings(texto):
     return embedding
 
 
-def actualizar_embedding(vehiculo):
+def actualizar_embedding(vehiculo, texto_nuevo=None, vehiculo_db=SIN_CONSULTAR):
     """
     Actualiza el embedding del vehículo según las siguientes reglas:
-    1. Busca el vehículo en MongoDB por su URL.
+    1. Busca el vehículo en MongoDB por su URL (salvo que ya se pase en vehiculo_db).
     2. Si ya existe:
         a. Si no tiene embedding, lo calcula y lo asigna al nuevo vehículo.
         b. Si tiene embedding, compara el texto generado del nuevo y el viejo vehículo:
@@ -428,8 +460,10 @@ def actualizar_embedding(vehiculo):
         print('Vehículo sin URL, no se puede actualizar embedding.')
         return vehiculo  # No se puede actualizar embedding sin URL
 
-    vehiculo_db = coleccion.find_one({'url': url})
-    texto_nuevo = generar_texto_documento(vehiculo)
+    if vehiculo_db is SIN_CONSULTAR:
+        vehiculo_db = coleccion.find_one({'url': url})
+    if texto_nuevo is None:
+        texto_nuevo = generar_texto_documento(vehiculo)
 
     if vehiculo_db:
         print(f'Vehículo encontrado en la base de datos')
@@ -454,52 +488,248 @@ def actualizar_embedding(vehiculo):
     return vehiculo
 
 
-def main():
-    page = 1
-    total_scrapeados = 0
-    urls_primera_pagina = set()
+def calcular_vecinos(k=None, bloque=1024):
+    """
+    Calcula los k vecinos más cercanos (similitud coseno) de cada vehículo a partir
+    de los embeddings guardados, en una pasada vectorizada por bloques sobre todo
+    el catálogo, y los guarda en el campo similares de cada coche.
+    Solo se escriben los coches cuya lista de similares ha cambiado.
+    """
+    k = k or numero_vecinos
+    documentos = list(coleccion.find(
+        {'embedding': {'$type': 'array'}},
+        {'_id': 0, 'url': 1, 'embedding': 1, 'similares': 1}
+    ))
+    if len(documentos) < 2:
+        return
+    urls = [doc['url'] for doc in documentos]
+    matriz = np.asarray([doc['embedding'] for doc in documentos], dtype=np.float32)
+    matriz /= np.maximum(np.linalg.norm(matriz, axis=1, keepdims=True), 1e-12)
+    k = min(k, len(documentos) - 1)
+
+    operaciones = []
+    for inicio in range(0, len(documentos), bloque):
+        similitudes = matriz[inicio:inicio + bloque] @ matriz.T
+        filas = np.arange(similitudes.shape[0])
+        # Excluir el propio vehículo
+        similitudes[filas, filas + inicio] = -np.inf
+        candidatos = np.argpartition(-similitudes, k - 1, axis=1)[:, :k]
+        orden = np.argsort(-similitudes[filas[:, None], candidatos], axis=1)
+        vecinos = np.take_along_axis(candidatos, orden, axis=1)
+        for fila, indices in enumerate(vecinos):
+            doc = documentos[inicio + fila]
+            similares = [
+                {'url': urls[j], 'similitud': round(float(similitudes[fila, j]), 4)}
+                for j in indices
+            ]
+            if doc.get('similares') != similares:
+                operaciones.append(UpdateOne({'url': doc['url']}, {'$set': {'similares': similares}}))
+
+    if operaciones:
+        coleccion.bulk_write(operaciones, ordered=False)
+    print(f"Vecinos calculados para {len(documentos)} coches ({len(operaciones)} actualizados).")
+
+
+def obtener_pagina_listado(page):
+    """
+    Descarga una página del listado y devuelve (soup, tarjetas de coche), o
+    (None, None) si la página no existe
+    """
+    url = base_url.format(page)
+    response = peticion_get(url, headers=headers)
+    if response.status_code != 200:
+        return None, None
+    archivar_pagina(url, response.content, 'listado')
+    soup = BeautifulSoup(response.text, 'html.parser')
+    return soup, soup.find_all('div', class_='container-coches')
+
+
+def obtener_total_paginas(soup):
+    """Lee el número total de páginas a partir de los enlaces de paginación de la página 1"""
+    paginas = []
+    for enlace in soup.find_all('a', href=True):
+        match = re.search(r'/renting/page/(\d+)/?', enlace['href'])
+        if match:
+            paginas.append(int(match.group(1)))
+    return max(paginas) if paginas else None
+
+
+def urls_de_coches(coches):
+    urls = set()
+    for coche in coches:
+        enlace_elem = coche.find('a', class_='enlace-car')
+        enlace = enlace_elem['href'] if enlace_elem else None
+        if enlace:
+            urls.add(enlace)
+    return urls
+
+
+def descubrir_listados_secuencial(cola, urls_primera_pagina):
+    """Recorre las páginas una a una hasta un error o una repetición de la página 1"""
+    page = 2
     while True:
         print(f"\nScrapeando página {page}...")
-        url = base_url.format(page)
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
+        _, coches = obtener_pagina_listado(page)
+        if coches is None:
             print("Fin del scraping. No más páginas.")
             break
-        soup = BeautifulSoup(response.text, 'html.parser')
-        coches = soup.find_all('div', class_='container-coches')
         if not coches:
             print("No hay más coches en esta página.")
             break
-        urls_actuales = set()
+        urls_actuales = urls_de_coches(coches)
+        # Si todas las URLs de la página actual están en la primera página, paramos
+        if urls_actuales and urls_actuales.issubset(urls_primera_pagina):
+            print("Detectada repetición de la primera página. Fin del scraping.")
+            break
         for coche in coches:
-            enlace_elem = coche.find('a', class_='enlace-car')
-            enlace = enlace_elem['href'] if enlace_elem else None
-            if enlace:
-                urls_actuales.add(enlace)
-        if page == 1:
-            urls_primera_pagina = urls_actuales.copy()
-        else:
-            # Si todas las URLs de la página actual están en la primera página, paramos
-            if urls_actuales and urls_actuales.issubset(urls_primera_pagina):
-                print("Detectada repetición de la primera página. Fin del scraping.")
-                break
+            cola.put(coche)
+        page += 1
+
+
+def descubrir_listados(cola):
+    """
+    Descubre las páginas del listado y va añadiendo sus coches a la cola en cuanto
+    llega cada página. Si la página 1 tiene paginación, el resto de páginas se
+    descargan en paralelo; si no, se recorren secuencialmente.
+    Al terminar añade None a la cola para indicar el final.
+    """
+    try:
+        print("\nScrapeando página 1...")
+        soup, coches = obtener_pagina_listado(1)
+        if not coches:
+            print("No hay coches en la primera página.")
+            return
         for coche in coches:
-            try:
-                vehiculo = obtener_datos_vehiculo(coche)
-                if vehiculo is None:
-                    time.sleep(0.3)
+            cola.put(coche)
+
+        total_paginas = obtener_total_paginas(soup)
+        if total_paginas is None:
+            print("Paginación no encontrada, recorriendo páginas secuencialmente.")
+            descubrir_listados_secuencial(cola, urls_de_coches(coches))
+            return
+
+        print(f"Total de páginas: {total_paginas}")
+        with ThreadPoolExecutor(max_workers=listado_workers) as executor:
+            futuros = {executor.submit(obtener_pagina_listado, page): page for page in range(2, total_paginas + 1)}
+            for futuro in as_completed(futuros):
+                page = futuros[futuro]
+                try:
+                    _, coches = futuro.result()
+                except Exception as e:
+                    print(f"Error descargando página {page}: {e}")
+                    continue
+                if coches is None:
+                    print(f"Página {page} no disponible.")
                     continue
+                print(f"Página {page} descargada ({len(coches)} coches).")
+                for coche in coches:
+                    cola.put(coche)
+    except Exception as e:
+        print(f"Error descubriendo páginas del listado: {e}")
+    finally:
+        cola.put(None)
+
+
+def guardar_resultados(resultados, vehiculos_db=None, registrar_precios=True):
+    """
+    Calcula el embedding y guarda cada par (documento, texto); devuelve cuántos se
+    guardaron. vehiculos_db tiene los documentos ya consultados por url, para no
+    volver a leerlos de Mongo.
+    """
+    guardados = 0
+    for vehiculo, texto in resultados:
+        try:
+            url = vehiculo.get('url')
+            if vehiculos_db is not None and url in vehiculos_db:
+                vehiculo_db = vehiculos_db.pop(url)
+            else:
+                vehiculo_db = coleccion.find_one({'url': url})
+            vehiculo = actualizar_embedding(vehiculo, texto, vehiculo_db)
+            guardar_en_mongodb(vehiculo, vehiculo_db, registrar_precios)
+            guardados += 1
+        except Exception as e:
+            print(f"Error procesando coche: {e}")
+    return guardados
+
+
+def recoger_lotes(pendientes, vehiculos_db, esperar=False):
+    """Guarda los lotes ya parseados en el pool (todos si esperar es True)"""
+    guardados = 0
+    for futuro in list(pendientes):
+        if not esperar and not futuro.done():
+            continue
+        pendientes.remove(futuro)
+        try:
+            guardados += guardar_resultados(futuro.result(), vehiculos_db)
+        except Exception as e:
+            print(f"Error parseando lote de coches: {e}")
+    return guardados
+
+
+def main():
+    # Con SCRAPER_PARSE_WORKERS > 0 el parseo se hace en lotes en un pool de procesos
+    # mientras este hilo sigue descargando; si no, se parsea cada coche en línea.
+    # Se crea lo primero, antes de conectar a Mongo y de lanzar hilos.
+    pool = crear_pool()
+
+    preparar_historial_precios()
+    total_scrapeados = 0
+    urls_vistas = set()
+    cola = queue.Queue()
+    productor = threading.Thread(target=descubrir_listados, args=(cola,), daemon=True)
+    productor.start()
+
+    lote = []
+    pendientes = []
+    # Documentos ya leídos de Mongo al descargar, pendientes de guardar
+    vehiculos_db = {}
 
-                vehiculo = procesar_documento_vehiculo(vehiculo)
-                vehiculo = actualizar_embedding(vehiculo)
-                guardar_en_mongodb(vehiculo)
-                total_scrapeados += 1
-                print(f"Coches scrapeados hasta ahora: {total_scrapeados}")
-                time.sleep(0.1)
+    while True:
+        coche = cola.get()
+        if coche is None:
+            break
+        enlace_elem = coche.find('a', class_='enlace-car')
+        enlace = enlace_elem['href'] if enlace_elem else None
+        if enlace:
+            if enlace in urls_vistas:
+                continue
+            urls_vistas.add(enlace)
+        try:
+            crudo, vehiculo_db = descargar_vehiculo(coche)
+        except Exception as e:
+            print(f"Error procesando coche: {e}")
+            continue
+        if crudo is None:
+            continue
+        vehiculos_db[crudo['url']] = vehiculo_db
+
+        if pool is None:
+            try:
+                guardados = guardar_resultados(construir_documentos([crudo]), vehiculos_db)
             except Exception as e:
                 print(f"Error procesando coche: {e}")
-        page += 1
+                continue
+        else:
+            lote.append(crudo)
+            if len(lote) >= parse_chunk:
+                pendientes.append(pool.submit(construir_documentos, lote))
+                lote = []
+            guardados = recoger_lotes(pendientes, vehiculos_db)
+        if guardados:
+            total_scrapeados += guardados
+            print(f"Coches scrapeados hasta ahora: {total_scrapeados}")
+
+    if pool is not None:
+        if lote:
+            pendientes.append(pool.submit(construir_documentos, lote))
+        total_scrapeados += recoger_lotes(pendientes, vehiculos_db, esperar=True)
+        pool.shutdown()
+
+    productor.join()
     print(f"Scraping completado. Total de coches procesados: {total_scrapeados}")
+    calcular_vecinos()
+    if directorio_snapshot:
+        exportar_snapshot(coleccion)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,294 @@
+"""
+Snapshot de solo lectura del catálogo para los workers de búsqueda.
+
+El scraper exporta tras cada ejecución una versión nueva en SNAPSHOT_DIR:
+
+    SNAPSHOT_DIR/
+        ACTUAL                  nombre de la versión vigente
+        20261019T120000/
+            meta.json           versión, ejes de precios y vocabularios de las columnas de texto
+            embedding.npy       float32 [n, dim], normalizados
+            precios.npy         float32 [n, duraciones, kms], NaN si no hay precio
+            <columna>.npy       columnas de filtro (códigos int32 o valores numéricos)
+            nombre.npy, url.npy campos a mostrar
+            similares.npy       int32 [n, k], índices de los vecinos (-1 si no hay)
+
+Los .npy se abren con mmap, así que abrir el snapshot apenas cuesta y los workers
+de una misma máquina comparten las páginas a través de la caché del sistema.
+MongoDB sigue siendo la fuente de verdad; el snapshot solo se regenera a partir de ella.
+
+Publicación: la versión vigente se empaqueta como snapshot.tar.gz (con el
+directorio de la versión dentro) junto al fichero ACTUAL. El snapshot contiene el
+catálogo completo con sus embeddings, así que el workflow solo lo sube a la release
+"snapshot" si la variable del repositorio PUBLICAR_SNAPSHOT vale 'true'; en un
+repositorio público esa release es pública, y activarla requiere el visto bueno
+explícito de los responsables del proyecto.
+
+Los workers de búsqueda pueden recibir el snapshot de dos formas:
+- Incluido en el despliegue (descargado en el build) y SNAPSHOT_DIR apuntando a él.
+- Con SNAPSHOT_URL (y SNAPSHOT_TOKEN si el origen exige autenticación): un hilo en
+  segundo plano lo descarga a un directorio temporal (/tmp) y comprueba ACTUAL cada
+  SNAPSHOT_COMPROBACION segundos. Las peticiones nunca esperan a la red; mientras
+  no haya ninguna versión descargada se responde con MongoDB, y si una descarga
+  falla se sigue con la versión que hubiera.
+"""
+import os
+import re
+import json
+import time
+import shutil
+import tarfile
+import tempfile
+import threading
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+directorio_snapshot = os.getenv('SNAPSHOT_DIR')
+url_snapshot = os.getenv('SNAPSHOT_URL')
+token_snapshot = os.getenv('SNAPSHOT_TOKEN')
+comprobacion_snapshot = float(os.getenv('SNAPSHOT_COMPROBACION', '300'))
+
+# Columnas de filtro: las de texto se guardan como códigos sobre un vocabulario
+COLUMNAS_TEXTO = ['tipo', 'color', 'tracción', 'transmisión', 'combustible']
+COLUMNAS_NUMERICAS = {'plazas': np.float32, 'año': np.float32, 'consumo_litros': np.float32}
+VERSIONES_CONSERVADAS = 3
+
+
+def exportar_snapshot(coleccion, directorio=None):
+    """Escribe una versión nueva del snapshot a partir de la colección y la marca como vigente"""
+    directorio = Path(directorio or directorio_snapshot)
+    proyeccion = {'_id': 0, 'nombre': 1, 'url': 1, 'precios': 1, 'embedding': 1, 'similares': 1}
+    for columna in COLUMNAS_TEXTO + list(COLUMNAS_NUMERICAS):
+        proyeccion[columna] = 1
+    documentos = list(coleccion.find({'embedding': {'$type': 'array'}}, proyeccion))
+    if not documentos:
+        print('No hay vehículos con embedding, no se exporta snapshot.')
+        return None
+
+    version = datetime.now().strftime('%Y%m%dT%H%M%S')
+    temporal = directorio / f'.{version}.tmp'
+    temporal.mkdir(parents=True, exist_ok=True)
+
+    embedding = np.asarray([doc['embedding'] for doc in documentos], dtype=np.float32)
+    embedding /= np.maximum(np.linalg.norm(embedding, axis=1, keepdims=True), 1e-12)
+    np.save(temporal / 'embedding.npy', embedding)
+
+    duraciones = sorted({p['duracion'] for doc in documentos for p in doc.get('precios', [])})
+    kms = sorted({p['kms'] for doc in documentos for p in doc.get('precios', [])})
+    indice_duracion = {d: i for i, d in enumerate(duraciones)}
+    indice_kms = {k: i for i, k in enumerate(kms)}
+    precios = np.full((len(documentos), len(duraciones), len(kms)), np.nan, dtype=np.float32)
+    for fila, doc in enumerate(documentos):
+        for p in doc.get('precios', []):
+            precios[fila, indice_duracion[p['duracion']], indice_kms[p['kms']]] = p['importe']
+    np.save(temporal / 'precios.npy', precios)
+
+    vocabularios = {}
+    for columna in COLUMNAS_TEXTO:
+        valores = [doc.get(columna) if isinstance(doc.get(columna), str) else None for doc in documentos]
+        vocabulario = sorted({v for v in valores if v is not None})
+        codigo = {v: i for i, v in enumerate(vocabulario)}
+        codigos = np.asarray([codigo[v] if v is not None else -1 for v in valores], dtype=np.int32)
+        np.save(temporal / f'{columna}.npy', codigos)
+        vocabularios[columna] = vocabulario
+    for columna, tipo in COLUMNAS_NUMERICAS.items():
+        valores = [doc.get(columna) if isinstance(doc.get(columna), (int, float)) else np.nan for doc in documentos]
+        np.save(temporal / f'{columna}.npy', np.asarray(valores, dtype=tipo))
+
+    urls = [doc['url'] for doc in documentos]
+    np.save(temporal / 'nombre.npy', np.asarray([doc.get('nombre', '') for doc in documentos], dtype=str))
+    np.save(temporal / 'url.npy', np.asarray(urls, dtype=str))
+
+    fila_url = {url: i for i, url in enumerate(urls)}
+    k = max((len(doc.get('similares', [])) for doc in documentos), default=0)
+    similares = np.full((len(documentos), k), -1, dtype=np.int32)
+    for fila, doc in enumerate(documentos):
+        indices = [fila_url[s['url']] for s in doc.get('similares', []) if s['url'] in fila_url]
+        similares[fila, :len(indices)] = indices
+    np.save(temporal / 'similares.npy', similares)
+
+    with open(temporal / 'meta.json', 'w', encoding='utf-8') as f:
+        json.dump({
+            'version': version,
+            'vehiculos': len(documentos),
+            'duraciones': duraciones,
+            'kms': kms,
+            'vocabularios': vocabularios
+        }, f, ensure_ascii=False)
+
+    # Publicar la versión de forma atómica: primero el directorio y luego el puntero
+    os.rename(temporal, directorio / version)
+    puntero = directorio / 'ACTUAL.tmp'
+    puntero.write_text(version)
+    os.replace(puntero, directorio / 'ACTUAL')
+
+    limpiar_versiones(directorio)
+
+    print(f"Snapshot {version} exportado con {len(documentos)} vehículos.")
+    return version
+
+
+def limpiar_versiones(directorio):
+    """Borra las versiones más antiguas (los procesos que las tengan abiertas con mmap siguen pudiendo leerlas)"""
+    versiones = sorted(p.name for p in Path(directorio).iterdir() if p.is_dir() and not p.name.startswith('.'))
+    for antigua in versiones[:-VERSIONES_CONSERVADAS]:
+        shutil.rmtree(Path(directorio) / antigua, ignore_errors=True)
+
+
+class Snapshot:
+    """Vista de solo lectura (mmap) de una versión del snapshot"""
+
+    def __init__(self, ruta):
+        with open(ruta / 'meta.json', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.version = self.meta['version']
+        self.columnas = {}
+        for fichero in ruta.glob('*.npy'):
+            self.columnas[fichero.stem] = np.load(fichero, mmap_mode='r')
+        self.fila_url = {str(url): fila for fila, url in enumerate(self.columnas['url'])}
+
+    def filtrar(self, match_conditions):
+        """Traduce las condiciones $match de drenting_tool a una máscara sobre las columnas"""
+        mascara = np.ones(self.meta['vehiculos'], dtype=bool)
+        for campo, condicion in match_conditions.items():
+            if campo not in self.columnas:
+                # Campo no exportado: ningún documento lo cumple, igual que en Mongo
+                return np.zeros_like(mascara)
+            columna = self.columnas[campo]
+            if campo in self.meta['vocabularios']:
+                patron = re.compile(condicion['$regex'], re.IGNORECASE if 'i' in condicion.get('$options', '') else 0)
+                codigos = [i for i, v in enumerate(self.meta['vocabularios'][campo]) if patron.search(v)]
+                mascara &= np.isin(columna, codigos)
+            elif isinstance(condicion, dict):
+                if '$gte' in condicion:
+                    mascara &= columna >= condicion['$gte']
+                if '$lte' in condicion:
+                    mascara &= columna <= condicion['$lte']
+            else:
+                mascara &= columna == condicion
+        return mascara
+
+    def vehiculo(self, fila):
+        """Devuelve nombre, url y precios de una fila con la forma de los documentos de Mongo"""
+        precios = []
+        matriz = self.columnas['precios'][fila]
+        for i, duracion in enumerate(self.meta['duraciones']):
+            for j, kms in enumerate(self.meta['kms']):
+                if not np.isnan(matriz[i, j]):
+                    precios.append({'duracion': duracion, 'kms': kms, 'importe': float(matriz[i, j])})
+        return {
+            'nombre': str(self.columnas['nombre'][fila]),
+            'url': str(self.columnas['url'][fila]),
+            'precios': precios
+        }
+
+    def buscar(self, embedding, mascara, limite):
+        """Los limite vehículos más similares al embedding entre los que cumplen la máscara"""
+        filas = np.flatnonzero(mascara)
+        if not len(filas):
+            return []
+        consulta = np.asarray(embedding, dtype=np.float32)
+        consulta /= max(float(np.linalg.norm(consulta)), 1e-12)
+        # Producto sobre el memmap completo y máscara sobre las puntuaciones, para no
+        # copiar las filas de la matriz de embeddings en cada consulta
+        similitudes = (self.columnas['embedding'] @ consulta)[filas]
+        limite = min(limite, len(filas))
+        mejores = np.argpartition(-similitudes, limite - 1)[:limite]
+        mejores = mejores[np.argsort(-similitudes[mejores])]
+        return [self.vehiculo(filas[i]) for i in mejores]
+
+    def similares(self, url):
+        """Vecinos precalculados del vehículo con esa url, en orden de similitud"""
+        fila = self.fila_url.get(url)
+        if fila is None:
+            return []
+        return [self.vehiculo(i) for i in self.columnas['similares'][fila] if i >= 0]
+
+
+_snapshot = None
+_actualizador = None
+_actualizador_lock = threading.Lock()
+
+
+def abrir_url(url, timeout):
+    peticion = urllib.request.Request(url)
+    if token_snapshot:
+        peticion.add_header('Authorization', f'Bearer {token_snapshot}')
+    return urllib.request.urlopen(peticion, timeout=timeout)
+
+
+def descargar_snapshot(url, directorio):
+    """
+    Descarga la versión publicada en url si no es la que ya hay en directorio y la
+    marca como vigente. La versión se toma del contenido del tar y no de ACTUAL, por
+    si la release se actualiza entre una descarga y otra.
+    """
+    directorio = Path(directorio)
+    with abrir_url(f'{url}/ACTUAL', timeout=10) as respuesta:
+        version_remota = respuesta.read().decode().strip()
+    if (directorio / version_remota).is_dir():
+        version = version_remota
+    else:
+        directorio.mkdir(parents=True, exist_ok=True)
+        temporal = Path(tempfile.mkdtemp(prefix='.descarga.', dir=directorio))
+        try:
+            with abrir_url(f'{url}/snapshot.tar.gz', timeout=60) as respuesta:
+                with tarfile.open(fileobj=respuesta, mode='r|gz') as tar:
+                    tar.extractall(temporal, filter='data')
+            version = next(p.name for p in temporal.iterdir() if p.is_dir())
+            if not (directorio / version).exists():
+                # Otro proceso puede haber publicado la misma versión a la vez
+                try:
+                    os.rename(temporal / version, directorio / version)
+                except OSError:
+                    pass
+        finally:
+            shutil.rmtree(temporal, ignore_errors=True)
+    puntero = directorio / f'ACTUAL.{os.getpid()}.tmp'
+    puntero.write_text(version)
+    os.replace(puntero, directorio / 'ACTUAL')
+    limpiar_versiones(directorio)
+
+
+def actualizar_snapshot(url, directorio):
+    """Bucle del hilo en segundo plano: descarga la versión publicada y vuelve a comprobar"""
+    while True:
+        try:
+            descargar_snapshot(url, directorio)
+        except Exception as e:
+            print(f"Error descargando snapshot de {url}: {e}")
+        time.sleep(comprobacion_snapshot)
+
+
+def iniciar_actualizacion(url, directorio):
+    """Arranca (una sola vez por proceso) el hilo que mantiene el snapshot descargado"""
+    global _actualizador
+    with _actualizador_lock:
+        if _actualizador is None:
+            _actualizador = threading.Thread(
+                target=actualizar_snapshot, args=(url, directorio), name='snapshot', daemon=True
+            )
+            _actualizador.start()
+
+
+def obtener_snapshot():
+    """
+    Abre (o reabre si se publicó una versión nueva) el snapshot vigente; None si no
+    hay. Solo lee ACTUAL del disco: las descargas las hace el hilo en segundo plano.
+    """
+    global _snapshot
+    directorio = directorio_snapshot
+    if not directorio and url_snapshot:
+        directorio = os.path.join(tempfile.gettempdir(), 'drenting_snapshot')
+        iniciar_actualizacion(url_snapshot, directorio)
+    if not directorio:
+        return None
+    try:
+        version = (Path(directorio) / 'ACTUAL').read_text().strip()
+    except FileNotFoundError:
+        return None
+    if _snapshot is None or _snapshot.version != version:
+        _snapshot = Snapshot(Path(directorio) / version)
+    return _snapshot